@@ -22,15 +22,20 @@ Features:
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import StreamingResponse, JSONResponse
 from starlette.background import BackgroundTask
-from contextlib import asynccontextmanager
+from collections.abc import Mapping
+from contextlib import asynccontextmanager, nullcontext
+from dataclasses import dataclass
+from functools import lru_cache
 import httpx
+import orjson
 import os
 import sys
 import json
 import logging
 import asyncio
+import itertools
 import random
-import uuid
+import re
 import time
 
 # Force unbuffered output so logs appear immediately in file
@@ -38,12 +43,22 @@ os.environ["PYTHONUNBUFFERED"] = "1"
 sys.stdout.reconfigure(line_buffering=True)
 sys.stderr.reconfigure(line_buffering=True)
 
-# ANSI colors
-GREEN = "\033[92m"
-RED = "\033[91m"
-YELLOW = "\033[93m"
-CYAN = "\033[96m"
-RESET = "\033[0m"
+# Load .env
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+# ANSI colors — only when stderr is a terminal, so piped/aggregated logs stay
+# plain. LOG_COLOR=always|never overrides detection (default: auto).
+LOG_COLOR = os.getenv("LOG_COLOR", "auto").lower()
+_USE_COLOR = LOG_COLOR == "always" or (LOG_COLOR != "never" and sys.stderr.isatty())
+GREEN = "\033[92m" if _USE_COLOR else ""
+RED = "\033[91m" if _USE_COLOR else ""
+YELLOW = "\033[93m" if _USE_COLOR else ""
+CYAN = "\033[96m" if _USE_COLOR else ""
+RESET = "\033[0m" if _USE_COLOR else ""
 
 # Configure logging
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
@@ -59,24 +74,25 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("httpcore").setLevel(logging.WARNING)
 
 
-def log_ok(rid: str, msg: str):
-    logger.info(f"{GREEN}[{rid}] {msg}{RESET}")
-
-def log_route(rid: str, msg: str):
-    logger.info(f"{CYAN}[{rid}] {msg}{RESET}")
+# Lazy %-formatting: `msg % args` only runs when the level is enabled, so hot
+# call sites pass a format string plus args instead of a prebuilt f-string.
+# Sites whose args are costly to compute (token/cost formatting) check
+# logger.isEnabledFor themselves.
+def log_ok(rid: str, msg: str, *args):
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("%s[%s] %s%s", GREEN, rid, msg % args if args else msg, RESET)
 
-def log_warn(rid: str, msg: str):
-    logger.warning(f"{YELLOW}[{rid}] {msg}{RESET}")
+def log_route(rid: str, msg: str, *args):
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("%s[%s] %s%s", CYAN, rid, msg % args if args else msg, RESET)
 
-def log_err(rid: str, msg: str):
-    logger.error(f"{RED}[{rid}] {msg}{RESET}")
+def log_warn(rid: str, msg: str, *args):
+    if logger.isEnabledFor(logging.WARNING):
+        logger.warning("%s[%s] %s%s", YELLOW, rid, msg % args if args else msg, RESET)
 
-# Load .env
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except ImportError:
-    pass
+def log_err(rid: str, msg: str, *args):
+    if logger.isEnabledFor(logging.ERROR):
+        logger.error("%s[%s] %s%s", RED, rid, msg % args if args else msg, RESET)
 
 
 @asynccontextmanager
@@ -87,17 +103,22 @@ async def lifespan(app: FastAPI):
         write=float(os.getenv("WRITE_TIMEOUT", "30")),
         pool=float(os.getenv("POOL_TIMEOUT", "5")),
     )
+    # Limits apply per client. A 60s keepalive keeps warm TLS connections
+    # across the usual gaps between Claude Code turns.
     limits = httpx.Limits(
-        max_connections=int(os.getenv("MAX_CONNECTIONS", "100")),
-        max_keepalive_connections=int(os.getenv("MAX_KEEPALIVE_CONNECTIONS", "20")),
-        keepalive_expiry=float(os.getenv("KEEPALIVE_EXPIRY", "30.0")),
+        max_connections=int(os.getenv("MAX_CONNECTIONS", "1000")),
+        max_keepalive_connections=int(os.getenv("MAX_KEEPALIVE_CONNECTIONS", "100")),
+        keepalive_expiry=float(os.getenv("KEEPALIVE_EXPIRY", "60.0")),
     )
-    app.state.http_client = httpx.AsyncClient(timeout=timeout_config, limits=limits)
-    logger.info("HTTP client ready")
+    # Separate pools so provider traffic can't starve Anthropic (incl. fallbacks)
+    app.state.provider_client = httpx.AsyncClient(timeout=timeout_config, limits=limits)
+    app.state.anthropic_client = httpx.AsyncClient(timeout=timeout_config, limits=limits)
+    logger.info("HTTP clients ready")
     stats.start_persistence()
     yield
     await stats.stop_persistence()
-    await app.state.http_client.aclose()
+    await app.state.provider_client.aclose()
+    await app.state.anthropic_client.aclose()
 
 
 app = FastAPI(title="Claude Code Proxy — Multi-Provider Router", lifespan=lifespan)
@@ -109,10 +130,9 @@ app = FastAPI(title="Claude Code Proxy — Multi-Provider Router", lifespan=life
 @app.middleware("http")
 async def log_all_requests(request: Request, call_next):
     """Log every incoming request for visibility, including sub-agent calls."""
-    method = request.method
-    path = request.url.path
-    client = request.client.host if request.client else "unknown"
-    logger.debug(f"→ {method} {path} from {client}")
+    if logger.isEnabledFor(logging.DEBUG):
+        client = request.client.host if request.client else "unknown"
+        logger.debug("→ %s %s from %s", request.method, request.url.path, client)
     response = await call_next(request)
     return response
 
@@ -128,6 +148,7 @@ OPUS_API_KEY = os.getenv("OPUS_PROVIDER_API_KEY")
 OPUS_BASE_URL = os.getenv("OPUS_PROVIDER_BASE_URL")
 
 ANTHROPIC_BASE_URL = "https://api.anthropic.com"
+ANTHROPIC_MESSAGES_URL = f"{ANTHROPIC_BASE_URL}/v1/messages"
 ANTHROPIC_MAX_RETRIES = int(os.getenv("ANTHROPIC_MAX_RETRIES", "2"))
 PORT = int(os.getenv("PORT", "8082"))
 
@@ -221,10 +242,17 @@ def _fmt_cost(input_tokens: int, output_tokens: int, tier: str) -> str:
     return f" ${cost:.4f}" if cost >= 0.0001 else f" ${cost:.6f}"
 
 
+# Per-tier concurrency, split by request kind so long generations of one kind
+# can't starve the other. MAX_CONCURRENT_REQUESTS stays the per-tier total
+# (providers may cap concurrency); non-streaming requests get a reserved
+# share of it (default 1/3) and streaming gets the rest, each at least 1.
 MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "15"))
-haiku_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-sonnet_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-opus_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+MAX_CONCURRENT_NON_STREAMING = max(1, int(os.getenv("MAX_CONCURRENT_NON_STREAMING", str(MAX_CONCURRENT_REQUESTS // 3))))
+MAX_CONCURRENT_STREAMING = max(1, MAX_CONCURRENT_REQUESTS - MAX_CONCURRENT_NON_STREAMING)
+_STREAM_SEMAPHORES = {tier: asyncio.Semaphore(MAX_CONCURRENT_STREAMING) for tier in ("haiku", "sonnet", "opus")}
+_NON_STREAM_SEMAPHORES = {tier: asyncio.Semaphore(MAX_CONCURRENT_NON_STREAMING) for tier in ("haiku", "sonnet", "opus")}
+# Anthropic routes are not throttled — shared, reusable no-op async context
+_NO_LIMIT = nullcontext()
 
 
 # ---------------------------------------------------------------------------
@@ -259,11 +287,17 @@ def validate_config():
 class CircuitBreaker:
     """
     Tracks failures per provider. After `threshold` consecutive failures,
-    opens the circuit for `recovery_time` seconds, routing to Anthropic instead.
-
-    Half-open probing: after `probe_after` seconds (< recovery_time), allow
-    a single in-flight probe request. If it succeeds, close immediately.
-    If it fails, the breaker stays open for the remaining recovery window.
+    opens the circuit, routing to Anthropic instead.
+
+    Half-open probing: after `probe_after` seconds, let at most
+    `half_open_max` probe requests through. The circuit closes once
+    `probe_successes` probes succeed; any probe failure re-opens it and
+    restarts the wait. Time alone never closes the circuit, so upstream
+    sees a trickle of probes rather than the full load after recovery.
+    Only probe outcomes move an open circuit: results of requests that were
+    already in flight when it tripped are ignored.
+    If probes never resolve (cancelled, client errors), the probe slots
+    are re-armed every `recovery_time` seconds (clamped above `probe_after`).
     """
 
     def __init__(
@@ -271,72 +305,119 @@ class CircuitBreaker:
         threshold: int = int(os.getenv("CIRCUIT_BREAKER_THRESHOLD", "5")),
         recovery_time: float = float(os.getenv("CIRCUIT_BREAKER_RECOVERY", "120")),
         probe_after: float = float(os.getenv("CIRCUIT_BREAKER_PROBE_AFTER", "30")),
+        half_open_max: int = int(os.getenv("CIRCUIT_BREAKER_HALF_OPEN_MAX", "3")),
+        probe_successes: int = int(os.getenv("CIRCUIT_BREAKER_PROBE_SUCCESSES", "2")),
     ):
         self.threshold = threshold
-        self.recovery_time = recovery_time
         self.probe_after = probe_after
+        # Re-arm must land inside the half-open window, or every call would
+        # re-arm and become a probe
+        self.recovery_time = max(recovery_time, probe_after + 1)
+        self.half_open_max = max(1, half_open_max)
+        self.probe_successes = min(probe_successes, self.half_open_max)
         self._failures: dict[str, int] = {}
         self._opened_at: dict[str, float] = {}
-        self._probe_in_flight: dict[str, bool] = {}
+        self._probes: dict[str, int] = {}       # probes issued in current half-open window
+        self._probe_ok: dict[str, int] = {}     # probes succeeded in current half-open window
 
     def _close(self, tier: str):
         """Reset state for a tier (circuit closed)."""
         self._failures.pop(tier, None)
         self._opened_at.pop(tier, None)
-        self._probe_in_flight.pop(tier, None)
+        self._probes.pop(tier, None)
+        self._probe_ok.pop(tier, None)
 
-    def is_open(self, tier: str) -> bool:
-        """Check if circuit is open (provider should be bypassed).
+    def _open(self, tier: str):
+        """(Re-)open the circuit for a tier and reset its half-open window."""
+        self._opened_at[tier] = time.monotonic()
+        self._probes.pop(tier, None)
+        self._probe_ok.pop(tier, None)
 
-        Returns False (lets request through) if the recovery window expired
-        OR if the half-open probe window opened and no probe is in flight.
+    def is_tripped(self, tier: str) -> bool:
+        """True while the circuit is open or half-open. Read-only, unlike admit()."""
+        return tier in self._opened_at
+
+    def admit(self, tier: str) -> tuple[bool, bool]:
+        """Return (is_open, is_probe) for a request about to be routed.
+
+        Lets the request through when the circuit is closed, or when it is
+        half-open and a probe slot is free — claiming that slot and marking
+        the request as a probe. Pass is_probe back to record_success/failure.
         """
-        if tier not in self._opened_at:
-            return False
-        elapsed = time.time() - self._opened_at[tier]
+        opened_at = self._opened_at.get(tier)
+        if opened_at is None:
+            return False, False
+        elapsed = time.monotonic() - opened_at
+        if elapsed < self.probe_after:
+            return True, False
         if elapsed >= self.recovery_time:
-            self._close(tier)
-            logger.info(f"{GREEN}Circuit closed for {tier} — retrying provider{RESET}")
-            return False
-        # Half-open: after probe_after, let exactly one request through to test
-        if elapsed >= self.probe_after and not self._probe_in_flight.get(tier):
-            self._probe_in_flight[tier] = True
+            # Probes never resolved — re-arm the half-open window
+            self._opened_at[tier] = time.monotonic() - self.probe_after
+            self._probes.pop(tier, None)
+            self._probe_ok.pop(tier, None)
+        probes = self._probes.get(tier, 0)
+        if probes >= self.half_open_max:
+            return True, False
+        self._probes[tier] = probes + 1
+        if probes == 0:
             logger.info(f"{CYAN}Circuit half-open for {tier} — probing provider{RESET}")
-            return False
-        return True
+        return False, True
 
-    def record_failure(self, tier: str):
-        """Record a failure. Opens circuit if threshold reached."""
-        # Probe failed — clear flag so a future probe can be issued
-        self._probe_in_flight.pop(tier, None)
-        self._failures[tier] = self._failures.get(tier, 0) + 1
-        if self._failures[tier] >= self.threshold and tier not in self._opened_at:
-            self._opened_at[tier] = time.time()
+    def record_failure(self, tier: str, is_probe: bool = False):
+        """Record a failure. Opens circuit if threshold reached; a failed probe re-opens it."""
+        if tier in self._opened_at:
+            if is_probe:
+                self._open(tier)
+                logger.warning(f"{YELLOW}Circuit re-opened for {tier} — probe failed{RESET}")
+            return
+        failures = self._failures.get(tier, 0) + 1
+        self._failures[tier] = failures
+        if failures >= self.threshold:
+            self._open(tier)
             logger.warning(
                 f"{YELLOW}Circuit OPEN for {tier} — "
-                f"bypassing provider for {self.recovery_time}s after "
-                f"{self._failures[tier]} failures{RESET}"
+                f"bypassing provider, probing after {self.probe_after}s "
+                f"({failures} failures){RESET}"
             )
 
-    def record_success(self, tier: str):
-        """Record a success. Resets failure count and closes circuit."""
+    def record_success(self, tier: str, is_probe: bool = False):
+        """Record a success. Resets failure count; closes a half-open circuit
+        once enough probes have succeeded."""
         if tier in self._opened_at:
-            logger.info(f"{GREEN}Circuit closed for {tier} — probe succeeded{RESET}")
+            if not is_probe:
+                return
+            ok = self._probe_ok.get(tier, 0) + 1
+            self._probe_ok[tier] = ok
+            if ok < self.probe_successes:
+                return
+            logger.info(f"{GREEN}Circuit closed for {tier} — {ok} probes succeeded{RESET}")
         self._close(tier)
 
     def status(self) -> dict:
-        """Return circuit status for health endpoint."""
+        """Return circuit status for health endpoint.
+
+        Read-only: works on a snapshot of the state and never calls admit(),
+        so polling /health cannot consume a half-open probe slot.
+        """
+        now = time.monotonic()
+        opened = self._opened_at.copy()
+        failures = self._failures.copy()
+        probes = self._probes.copy()
+        probe_ok = self._probe_ok.copy()
         result = {}
         for tier in ("haiku", "sonnet", "opus"):
-            if tier in self._opened_at and not self.is_open(tier):
-                # Half-open with probe in flight (is_open just released a probe)
-                result[tier] = "HALF-OPEN (probing)"
-            elif self.is_open(tier):
-                remaining = self.recovery_time - (time.time() - self._opened_at[tier])
-                result[tier] = f"OPEN (bypass for {remaining:.0f}s more)"
+            opened_at = opened.get(tier)
+            if opened_at is None:
+                result[tier] = f"CLOSED ({failures.get(tier, 0)}/{self.threshold} failures)"
+                continue
+            wait = self.probe_after - (now - opened_at)
+            if wait > 0:
+                result[tier] = f"OPEN (probing in {wait:.0f}s)"
             else:
-                failures = self._failures.get(tier, 0)
-                result[tier] = f"CLOSED ({failures}/{self.threshold} failures)"
+                result[tier] = (
+                    f"HALF-OPEN ({probe_ok.get(tier, 0)}/{self.probe_successes} probes ok, "
+                    f"{probes.get(tier, 0)}/{self.half_open_max} issued)"
+                )
         return result
 
 
@@ -488,49 +569,64 @@ stats = ProxyStats()
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
+# Request IDs only correlate log lines: random per-process prefix + wrapping
+# 16-bit counter, 8 hex chars total
+_RID_PREFIX = os.urandom(2).hex()
+_RID_COUNTER = itertools.count()
+
+
 def short_id() -> str:
-    return uuid.uuid4().hex[:8]
+    return f"{_RID_PREFIX}{next(_RID_COUNTER) & 0xFFFF:04x}"
+
+
+# One case-insensitive scan; group index maps to _TIER_BY_GROUP and doubles
+# as priority (opus > sonnet > haiku > glm) when a name holds several keywords.
+# Direct glm-5/glm-5.1 requests (legacy config) are treated as sonnet tier.
+_TIER_RE = re.compile(r"(opus)|(sonnet)|(haiku)|(^glm)", re.IGNORECASE)
+_TIER_BY_GROUP = (None, "opus", "sonnet", "haiku", "sonnet")
 
 
 def _detect_tier(model_name: str) -> str | None:
     """Detect model tier from Claude Code's model name via substring matching."""
-    m = model_name.lower()
-    if "opus" in m:
-        return "opus"
-    elif "sonnet" in m:
-        return "sonnet"
-    elif "haiku" in m:
-        return "haiku"
-    # Also catch direct glm-5/glm-5.1 requests (legacy config)
-    elif m.startswith("glm"):
-        return "sonnet"  # treat GLM models as sonnet tier
-    return None
+    group = min((m.lastindex for m in _TIER_RE.finditer(model_name)), default=0)
+    return _TIER_BY_GROUP[group]
+
+
+def _provider_base_headers(api_key: str | None) -> dict[str, str]:
+    """Static part of the request headers for a provider (copied per request)."""
+    headers = {"Content-Type": "application/json"}
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+        headers["x-api-key"] = api_key
+    return headers
+
+
+# Built once at startup — provider keys don't change while the proxy runs
+PROVIDER_HEADERS = {
+    "opus": _provider_base_headers(OPUS_API_KEY),
+    "sonnet": _provider_base_headers(SONNET_API_KEY),
+    "haiku": _provider_base_headers(HAIKU_API_KEY),
+}
 
 
-def get_provider_config(model_name: str):
+@lru_cache(maxsize=64)
+def _route(model_name: str) -> tuple[str | None, str | None, str | None]:
     """
-    Route by model tier (substring detection).
-    Returns (api_key, base_url, provider_label, semaphore) or None for Anthropic passthrough.
+    Resolve (target_url, provider_label, tier) for a model name.
+    target_url is None for Anthropic passthrough. Provider config is fixed at
+    startup and Claude Code sends only a handful of model names, so memoize.
     """
     tier = _detect_tier(model_name)
 
-    if tier == "opus":
-        if OPUS_BASE_URL:
-            return (OPUS_API_KEY, OPUS_BASE_URL, PROVIDER_OPUS_MODEL, opus_semaphore)
-        return None  # Opus → Anthropic OAuth
-
-    elif tier == "sonnet":
-        if SONNET_BASE_URL:
-            return (SONNET_API_KEY, SONNET_BASE_URL, PROVIDER_SONNET_MODEL, sonnet_semaphore)
-        return None
-
-    elif tier == "haiku":
-        if HAIKU_BASE_URL:
-            return (HAIKU_API_KEY, HAIKU_BASE_URL, PROVIDER_HAIKU_MODEL, haiku_semaphore)
-        return None
+    if tier == "opus" and OPUS_BASE_URL:
+        return (f"{OPUS_BASE_URL}/v1/messages", PROVIDER_OPUS_MODEL, tier)
+    elif tier == "sonnet" and SONNET_BASE_URL:
+        return (f"{SONNET_BASE_URL}/v1/messages", PROVIDER_SONNET_MODEL, tier)
+    elif tier == "haiku" and HAIKU_BASE_URL:
+        return (f"{HAIKU_BASE_URL}/v1/messages", PROVIDER_HAIKU_MODEL, tier)
 
-    # Unknown model → passthrough to Anthropic
-    return None
+    # Unconfigured tier or unknown model → passthrough to Anthropic
+    return (None, None, tier)
 
 
 def calculate_retry_delay(attempt: int) -> float:
@@ -538,17 +634,29 @@ def calculate_retry_delay(attempt: int) -> float:
     return random.uniform(0, max_delay)
 
 
+# Response headers invalidated by httpx decompression (cause ZlibError downstream)
+_ENCODING_HEADERS = frozenset({"content-encoding", "transfer-encoding", "content-length"})
+
+
 def strip_encoding_headers(headers) -> dict:
     """Remove encoding headers that cause ZlibError (httpx already decompresses)."""
-    return {
-        k: v for k, v in headers.items()
-        if k.lower() not in ("content-encoding", "transfer-encoding", "content-length")
-    }
+    return {k: v for k, v in headers.items() if k.lower() not in _ENCODING_HEADERS}
 
 
 # ---------------------------------------------------------------------------
 # Incompatibility detection (triggers Anthropic fallback)
 # ---------------------------------------------------------------------------
+# Raw-body markers: the matching check below can only succeed if one is present
+_WEB_TOOL_MARKERS = (b'"web_search', b'"web_fetch')
+_IMAGE_MARKERS = (b'"image', b'"source"')  # keys, not values: "url" is common in tool schemas
+_DOCUMENT_MARKER = b'"document"'
+
+
+def _contains_any(raw: bytes, markers: tuple[bytes, ...]) -> bool:
+    """True if any marker occurs in raw (C-level byte scan, no JSON walk)."""
+    return any(marker in raw for marker in markers)
+
+
 def _has_server_web_tools(data: dict) -> str | None:
     """Check for Anthropic server web tools (web_search, web_fetch). Returns bypass reason or None."""
     for tool in data.get("tools", []):
@@ -561,7 +669,13 @@ def _has_server_web_tools(data: dict) -> str | None:
     return None
 
 
-def _has_image_content(data: dict) -> bool:
+def _has_media_content(data: dict) -> str | None:
+    """Single walk over messages for image and document content blocks.
+
+    Image wins over document regardless of position (any block with a
+    base64/url source counts as image). Returns bypass reason or None.
+    """
+    has_document = False
     for msg in data.get("messages", []):
         if not isinstance(msg, dict):
             continue
@@ -572,24 +686,13 @@ def _has_image_content(data: dict) -> bool:
                     continue
                 btype = block.get("type", "")
                 if btype in ("image", "image_url"):
-                    return True
+                    return "vision/image"
                 source = block.get("source", {})
                 if isinstance(source, dict) and source.get("type") in ("base64", "url"):
-                    return True
-    return False
-
-
-def _has_document_content(data: dict) -> bool:
-    """Check if any message contains document content blocks (PDF, etc.)."""
-    for msg in data.get("messages", []):
-        if not isinstance(msg, dict):
-            continue
-        content = msg.get("content")
-        if isinstance(content, list):
-            for block in content:
-                if isinstance(block, dict) and block.get("type") == "document":
-                    return True
-    return False
+                    return "vision/image"
+                if btype == "document":
+                    has_document = True
+    return "document/pdf" if has_document else None
 
 
 def _has_forced_tool_choice(data: dict) -> bool:
@@ -602,20 +705,87 @@ def _has_forced_tool_choice(data: dict) -> bool:
     return False
 
 
+def _detect_bypass(data: dict, raw: bytes) -> str | None:
+    """Return the reason a provider-bound request must go to Anthropic, or None.
+
+    Priority: server web tools > vision/image > document/pdf > forced
+    tool_choice. Tools and messages are each walked at most once, and only
+    when the raw body contains a marker that could match.
+    """
+    if _contains_any(raw, _WEB_TOOL_MARKERS):
+        web_reason = _has_server_web_tools(data)
+        if web_reason:
+            return web_reason
+    if _contains_any(raw, _IMAGE_MARKERS) or _DOCUMENT_MARKER in raw:
+        media_reason = _has_media_content(data)
+        if media_reason:
+            return media_reason
+    if not ALLOW_FORCED_TOOL_CHOICE and _has_forced_tool_choice(data):
+        return "forced_tool_choice"
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Routing decision — provider config, bypass and circuit breaker in one call
+# ---------------------------------------------------------------------------
+@dataclass(slots=True)
+class RouteDecision:
+    """Where a /v1/messages request goes. Provider fields are None for Anthropic."""
+    tier: str | None
+    target_url: str
+    is_provider: bool = False
+    provider_label: str | None = None
+    semaphore: asyncio.Semaphore | None = None
+    bypass_reason: str | None = None
+    breaker_open: bool = False
+    is_probe: bool = False
+
+
+def decide_route(model_name: str, data: dict, raw: bytes, is_streaming: bool) -> RouteDecision:
+    """Resolve the route for a request once: tier + provider config (cached in
+    _route), then Anthropic bypass for incompatible features, then circuit breaker.
+    """
+    target_url, provider_label, tier = _route(model_name)
+    if not target_url:
+        return RouteDecision(tier, ANTHROPIC_MESSAGES_URL)
+    bypass_reason = _detect_bypass(data, raw)
+    if bypass_reason:
+        return RouteDecision(tier, ANTHROPIC_MESSAGES_URL, bypass_reason=bypass_reason)
+    breaker_open, is_probe = circuit_breaker.admit(tier)
+    if breaker_open:
+        return RouteDecision(tier, ANTHROPIC_MESSAGES_URL, breaker_open=True)
+    semaphores = _STREAM_SEMAPHORES if is_streaming else _NON_STREAM_SEMAPHORES
+    return RouteDecision(
+        tier, target_url, is_provider=True,
+        provider_label=provider_label, semaphore=semaphores[tier], is_probe=is_probe,
+    )
+
+
 # ---------------------------------------------------------------------------
 # Z.AI request sanitization
 # ---------------------------------------------------------------------------
-def sanitize_for_zai(data: dict, rid: str) -> dict:
-    """Strip/convert Anthropic-specific parameters for Z.AI compatibility."""
+_UNSUPPORTED_TOP_LEVEL = (
+    "metadata", "prompt_caching", "service_tier", "context_management",
+    "output_config", "inference_geo", "container", "citations",
+    "betas", "effort", "speed", "mcp_servers",
+)
+
+
+def sanitize_for_zai(data: dict, rid: str, raw: bytes | None = None) -> dict:
+    """Strip/convert Anthropic-specific parameters for Z.AI compatibility.
+
+    `raw` is the original request body. When given, the system prompt and
+    message history walks are skipped if none of the keys/block types they
+    act on appear in it — a C-level byte scan instead of a Python-level walk.
+    """
     removed = []
 
     # Remove unsupported top-level parameters
-    for key in ["metadata", "prompt_caching", "service_tier", "context_management",
-                 "output_config", "inference_geo", "container", "citations",
-                 "betas", "effort", "speed", "mcp_servers"]:
-        if key in data:
-            data.pop(key)
-            removed.append(key)
+    if not data.keys().isdisjoint(_UNSUPPORTED_TOP_LEVEL):
+        for key in _UNSUPPORTED_TOP_LEVEL:
+            if key in data:
+                data.pop(key)
+                removed.append(key)
 
     # Thinking: normalize for Z.AI compatibility
     # - Z.AI supports {type: "enabled"} but not {type: "adaptive"} (Opus/Sonnet 4.6+)
@@ -637,25 +807,44 @@ def sanitize_for_zai(data: dict, rid: str) -> dict:
         data.pop("extended_thinking")
         removed.append("extended_thinking")
 
-    # Strip Anthropic server tools and tool search tools (bypass handles most, double-safe)
-    _server_tool_prefixes = ("web_search", "web_fetch", "tool_search_tool")
+    strip_cache = not PROVIDER_PASS_CACHE_CONTROL
+    cache_cleaned = 0
+
+    # Strip cache_control from the system prompt unless passthrough is enabled
+    system = data.get("system")
+    if strip_cache and (raw is None or _CACHE_CONTROL_MARKER in raw):
+        if isinstance(system, list):
+            for block in system:
+                if isinstance(block, dict) and "cache_control" in block:
+                    block.pop("cache_control")
+                    cache_cleaned += 1
+        elif isinstance(system, dict) and "cache_control" in system:
+            system.pop("cache_control")
+            cache_cleaned += 1
+
+    # Tools — single pass: drop Anthropic server tools and tool search tools
+    # (bypass handles most, double-safe), strip advanced tool-use fields
+    # unsupported by Z.AI, and strip cache_control
     if "tools" in data and isinstance(data["tools"], list):
         original_count = len(data["tools"])
-        data["tools"] = [
-            t for t in data["tools"]
-            if not (isinstance(t, dict) and str(t.get("type", "")).startswith(_server_tool_prefixes))
-        ]
-        stripped = original_count - len(data["tools"])
-        if stripped:
-            removed.append(f"server_tools(x{stripped})")
-        # Strip advanced tool-use fields unsupported by Z.AI
+        kept_tools = []
         tool_fields_stripped = 0
         for tool in data["tools"]:
             if isinstance(tool, dict):
-                for key in ("defer_loading", "allowed_callers", "input_examples"):
+                if str(tool.get("type", "")).startswith(_SERVER_TOOL_PREFIXES):
+                    continue
+                for key in _UNSUPPORTED_TOOL_FIELDS:
                     if key in tool:
                         tool.pop(key)
                         tool_fields_stripped += 1
+                if strip_cache and "cache_control" in tool:
+                    tool.pop("cache_control")
+                    cache_cleaned += 1
+            kept_tools.append(tool)
+        data["tools"] = kept_tools
+        stripped = original_count - len(kept_tools)
+        if stripped:
+            removed.append(f"server_tools(x{stripped})")
         if tool_fields_stripped:
             removed.append(f"tool_fields(x{tool_fields_stripped})")
         if not data["tools"]:
@@ -670,22 +859,23 @@ def sanitize_for_zai(data: dict, rid: str) -> dict:
                 data.pop("tool_choice")
                 removed.append(f"tool_choice({tc_name})")
 
-    # Strip Anthropic-specific blocks from message history
-    # (thinking with signature, server tool blocks unknown to Z.AI, citations on text)
-    blocks_stripped, citations_stripped = _strip_anthropic_blocks(data)
+    # Messages — single pass: strip Anthropic-specific blocks from history
+    # (thinking with signature, server tool blocks unknown to Z.AI, citations
+    # on text) and cache_control on messages/blocks
+    if raw is None or _contains_any(raw, _HISTORY_MARKERS):
+        blocks_stripped, citations_stripped, msg_cache_cleaned = _sanitize_messages(data, strip_cache)
+        cache_cleaned += msg_cache_cleaned
+    else:
+        blocks_stripped = citations_stripped = 0
     if blocks_stripped:
         removed.append(f"anthropic_blocks(x{blocks_stripped})")
     if citations_stripped:
         removed.append(f"block_citations(x{citations_stripped})")
+    if cache_cleaned:
+        removed.append(f"cache_control(x{cache_cleaned})")
 
-    # Strip cache_control unless passthrough is enabled
-    if not PROVIDER_PASS_CACHE_CONTROL:
-        cache_cleaned = _strip_cache_control(data)
-        if cache_cleaned:
-            removed.append(f"cache_control(x{cache_cleaned})")
-
-    if removed:
-        logger.debug(f"[{rid}] Sanitized: {', '.join(removed)}")
+    if removed and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[%s] Sanitized: %s", rid, ", ".join(removed))
 
     return data
 
@@ -699,47 +889,75 @@ _SERVER_TOOL_BLOCKS = frozenset({
     "web_search_tool_result", "web_fetch_tool_result", # server tool results
 })
 _THINKING_BLOCKS = frozenset({"thinking", "redacted_thinking"})
+_HISTORY_STRIP_BLOCKS = _SERVER_TOOL_BLOCKS | _THINKING_BLOCKS if PROVIDER_STRIP_THINKING else _SERVER_TOOL_BLOCKS
+# Raw-body markers: if none is present, the system/history walks are no-ops
+# (b"[]" covers assistant messages with empty content, which get a placeholder)
+_CACHE_CONTROL_MARKER = b'"cache_control"'
+_HISTORY_MARKERS = tuple(f'"{t}"'.encode() for t in sorted(_HISTORY_STRIP_BLOCKS)) + (b'"citations"', b"[]")
+if not PROVIDER_PASS_CACHE_CONTROL:
+    _HISTORY_MARKERS += (_CACHE_CONTROL_MARKER,)
+# Anthropic server tools / tool search tools and tool fields unsupported by providers
+_SERVER_TOOL_PREFIXES = ("web_search", "web_fetch", "tool_search_tool")
+_UNSUPPORTED_TOOL_FIELDS = ("defer_loading", "allowed_callers", "input_examples")
 
 
-def _strip_anthropic_blocks(data: dict) -> tuple[int, int]:
-    """Remove Anthropic-specific content blocks from assistant messages.
+def _sanitize_messages(data: dict, strip_cache: bool) -> tuple[int, int, int]:
+    """Sanitize message history for the provider in a single pass.
 
-    Always strips: server_tool_use, web_search_tool_result, web_fetch_tool_result
-    (never meaningful outside Anthropic). Also strips `citations` from text blocks.
+    Always strips from assistant messages: server_tool_use,
+    web_search_tool_result, web_fetch_tool_result (never meaningful outside
+    Anthropic), and `citations` from text blocks.
 
     Conditionally strips thinking/redacted_thinking when PROVIDER_STRIP_THINKING=1.
     MiMo and MiniMax require these blocks for best multi-turn tool performance,
     while Z.AI GLM rejects them (signature validation mismatch).
 
-    Returns (blocks_removed, citations_removed).
+    When strip_cache is set, also removes cache_control from every message
+    and every kept content block.
+
+    Returns (blocks_removed, citations_removed, cache_control_removed).
     """
-    strip_types = set(_SERVER_TOOL_BLOCKS)
-    if PROVIDER_STRIP_THINKING:
-        strip_types |= _THINKING_BLOCKS
+    strip_types = _HISTORY_STRIP_BLOCKS
     blocks_removed = 0
     citations_removed = 0
+    cache_removed = 0
     for msg in data.get("messages", []):
-        if not isinstance(msg, dict) or msg.get("role") != "assistant":
+        if not isinstance(msg, dict):
             continue
+        if strip_cache and "cache_control" in msg:
+            msg.pop("cache_control")
+            cache_removed += 1
         content = msg.get("content")
         if not isinstance(content, list):
             continue
+        is_assistant = msg.get("role") == "assistant"
+        if not is_assistant:
+            if strip_cache:
+                for block in content:
+                    if isinstance(block, dict) and "cache_control" in block:
+                        block.pop("cache_control")
+                        cache_removed += 1
+            continue
         original_len = len(content)
         new_content = []
         for block in content:
-            if isinstance(block, dict) and block.get("type") in strip_types:
-                continue  # strip entire block
-            # Strip citations from text blocks (Anthropic-only field)
-            if isinstance(block, dict) and "citations" in block:
-                block.pop("citations")
-                citations_removed += 1
+            if isinstance(block, dict):
+                if block.get("type") in strip_types:
+                    continue  # strip entire block
+                # Strip citations from text blocks (Anthropic-only field)
+                if "citations" in block:
+                    block.pop("citations")
+                    citations_removed += 1
+                if strip_cache and "cache_control" in block:
+                    block.pop("cache_control")
+                    cache_removed += 1
             new_content.append(block)
         msg["content"] = new_content
-        blocks_removed += original_len - len(msg["content"])
+        blocks_removed += original_len - len(new_content)
         # If all blocks were stripped, keep at least an empty text block
-        if not msg["content"]:
+        if not new_content:
             msg["content"] = [{"type": "text", "text": ""}]
-    return blocks_removed, citations_removed
+    return blocks_removed, citations_removed, cache_removed
 
 
 def _strip_thinking_from_history(data: dict) -> int:
@@ -788,83 +1006,68 @@ def _sanitize_for_anthropic(data: dict, rid: str) -> dict:
     and extended_thinking. Mutates and returns the dict.
 
     Used both for direct Anthropic routes and for fallbacks from failed
-    provider routes (where original_data may contain MiniMax/Z.AI thinking
+    provider routes (where the original request may contain MiniMax/Z.AI thinking
     blocks with invalid signatures that Anthropic rejects with HTTP 400).
     """
     if _has_mixed_providers():
         stripped = _strip_thinking_from_history(data)
         if stripped:
-            logger.debug(f"[{rid}] Stripped {stripped} thinking blocks for Anthropic")
+            logger.debug("[%s] Stripped %d thinking blocks for Anthropic", rid, stripped)
     if "extended_thinking" in data:
         data.pop("extended_thinking")
-        logger.debug(f"[{rid}] Stripped extended_thinking for Anthropic")
+        logger.debug("[%s] Stripped extended_thinking for Anthropic", rid)
     return data
 
 
-def _strip_cache_control(data: dict) -> int:
-    """Recursively strip cache_control from system, messages, tools."""
-    count = 0
-
-    system = data.get("system")
-    if isinstance(system, list):
-        for block in system:
-            if isinstance(block, dict) and "cache_control" in block:
-                block.pop("cache_control")
-                count += 1
-    elif isinstance(system, dict) and "cache_control" in system:
-        system.pop("cache_control")
-        count += 1
+# Raw-body markers: if none is present, _sanitize_for_anthropic and the [1m]
+# model normalization are no-ops (b"[]" covers empty assistant content, which
+# gets a placeholder block)
+_ANTHROPIC_SANITIZE_MARKERS = (b'thinking"', b"[]", b'[1m]"')
 
-    for msg in data.get("messages", []):
-        if not isinstance(msg, dict):
-            continue
-        if "cache_control" in msg:
-            msg.pop("cache_control")
-            count += 1
-        if isinstance(msg.get("content"), list):
-            for block in msg["content"]:
-                if isinstance(block, dict) and "cache_control" in block:
-                    block.pop("cache_control")
-                    count += 1
 
-    for tool in data.get("tools", []):
-        if isinstance(tool, dict) and "cache_control" in tool:
-            tool.pop("cache_control")
-            count += 1
+def _anthropic_fallback_body(raw: bytes, rid: str) -> bytes:
+    """Build the encoded request body for an Anthropic fallback.
 
-    return count
+    Provider routes rewrite the model and sanitize `data` in place, so the
+    fallback body is rebuilt from the original request bytes — paid only
+    when a fallback actually fires. When there is nothing to normalize or
+    strip, the original bytes are forwarded as-is.
+    """
+    if not _contains_any(raw, _ANTHROPIC_SANITIZE_MARKERS):
+        return raw
+    data = orjson.loads(raw)
+    model = data.get("model", "")
+    if isinstance(model, str) and model.endswith("[1m]"):
+        data["model"] = model[:-4]
+    return orjson.dumps(_sanitize_for_anthropic(data, rid))
 
 
 # ---------------------------------------------------------------------------
 # Streaming wrapper
 # ---------------------------------------------------------------------------
-def _estimate_input_tokens(data: dict) -> int:
-    """Estimate input tokens from request body when provider doesn't return them.
+def _estimate_input_tokens(body: bytes) -> int:
+    """Estimate input tokens from the encoded request body when provider doesn't return them.
 
     Uses ~4 characters per token as a rough approximation (standard for English).
-    Returns 0 if estimation fails.
+    Counts decoded characters, not UTF-8 bytes, so non-ASCII prompts aren't inflated.
     """
-    try:
-        body_str = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
-        return max(1, len(body_str) // 4)
-    except (TypeError, ValueError):
-        return 0
+    return max(1, len(body.decode(errors="replace")) // 4)
 
 
 def _extract_tokens_from_response(content: bytes) -> tuple[int, int]:
     """Extract input/output tokens from a non-streaming Anthropic API response."""
     try:
-        body = json.loads(content)
+        body = orjson.loads(content)
         usage = body.get("usage", {})
         return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
-    except (json.JSONDecodeError, AttributeError):
+    except (orjson.JSONDecodeError, AttributeError):
         return 0, 0
 
 
 def _scale_response_usage(content: bytes, tier: str) -> bytes:
     """Rewrite usage tokens in a non-streaming response for correct cost display."""
     try:
-        body = json.loads(content)
+        body = orjson.loads(content)
         usage = body.get("usage")
         if not isinstance(usage, dict):
             return content
@@ -875,8 +1078,8 @@ def _scale_response_usage(content: bytes, tier: str) -> bytes:
         for cache_key in ("cache_creation_input_tokens", "cache_read_input_tokens"):
             if usage.get(cache_key, 0):
                 usage[cache_key] = _scale_tokens(usage[cache_key], tier, "input")
-        return json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode()
-    except (json.JSONDecodeError, AttributeError):
+        return orjson.dumps(body)
+    except (orjson.JSONDecodeError, AttributeError):
         return content
 
 
@@ -923,7 +1126,7 @@ async def safe_stream_wrapper(
                             new_lines.append(line)
                             continue
                         try:
-                            data = json.loads(line[6:])
+                            data = orjson.loads(line[6:])
                             evt_type = data.get("type")
                             if evt_type == "message_start":
                                 usage = data.get("message", {}).get("usage", {})
@@ -944,10 +1147,10 @@ async def safe_stream_wrapper(
                                     usage["output_tokens"] = _scale_tokens(real_out, price_tier, "output")
                                     modified = True
                             if modified:
-                                new_lines.append(b"data: " + json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode())
+                                new_lines.append(b"data: " + orjson.dumps(data))
                             else:
                                 new_lines.append(line)
-                        except (json.JSONDecodeError, AttributeError):
+                        except (orjson.JSONDecodeError, AttributeError):
                             new_lines.append(line)
                     if modified:
                         event_out = b"\n".join(new_lines)
@@ -972,20 +1175,21 @@ async def safe_stream_wrapper(
             estimated = True
         if stats_tier and (input_tokens or output_tokens):
             await stats.record_tokens(stats_tier, input_tokens, output_tokens)
-        elapsed = f" ({time.time() - start_time:.1f}s)" if start_time else ""
-        fmt = stats._fmt_tokens  # reuse compact formatter
-        if input_tokens or output_tokens:
-            in_prefix = "~" if estimated else ""
-            cost_str = _fmt_cost(input_tokens, output_tokens, stats_tier) if stats_tier else ""
-            log_ok(rid, f"Done {in_prefix}{fmt(input_tokens)} in / {fmt(output_tokens)} out{elapsed}{cost_str}")
-        elif start_time:
-            log_ok(rid, f"Done{elapsed}")
+        if logger.isEnabledFor(logging.INFO):
+            elapsed = f" ({time.time() - start_time:.1f}s)" if start_time else ""
+            fmt = stats._fmt_tokens  # reuse compact formatter
+            if input_tokens or output_tokens:
+                in_prefix = "~" if estimated else ""
+                cost_str = _fmt_cost(input_tokens, output_tokens, stats_tier) if stats_tier else ""
+                log_ok(rid, f"Done {in_prefix}{fmt(input_tokens)} in / {fmt(output_tokens)} out{elapsed}{cost_str}")
+            elif start_time:
+                log_ok(rid, f"Done{elapsed}")
 
 
 # ---------------------------------------------------------------------------
 # Main proxy endpoint
 # ---------------------------------------------------------------------------
-def _is_zai_server_error_status(status_code: int, body_str: str = "") -> bool:
+def _is_zai_server_error_status(status_code: int, body: bytes = b"") -> bool:
     """Detect Z.AI server errors that should trigger Anthropic fallback.
 
     Triggers on:
@@ -994,12 +1198,12 @@ def _is_zai_server_error_status(status_code: int, body_str: str = "") -> bool:
     """
     if status_code >= 500:
         return True
-    if status_code == 400 and ('"code":"500"' in body_str or '"code": "500"' in body_str):
+    if status_code == 400 and (b'"code":"500"' in body or b'"code": "500"' in body):
         return True
     return False
 
 
-def _is_overloaded(status_code: int, body_str: str = "") -> bool:
+def _is_overloaded(status_code: int, body: bytes = b"") -> bool:
     """Detect overload/rate-limit signals on the provider.
 
     Overload != crash: retrying immediately on the same provider only worsens
@@ -1013,23 +1217,29 @@ def _is_overloaded(status_code: int, body_str: str = "") -> bool:
     """
     if status_code in (429, 503, 529):
         return True
-    if '"overloaded_error"' in body_str or '"type":"overloaded"' in body_str:
+    if b'"overloaded_error"' in body or b'"type":"overloaded"' in body:
         return True
-    if '"rate_limit_error"' in body_str:
+    if b'"rate_limit_error"' in body:
         return True
     return False
 
 
-def _build_anthropic_headers(original_headers: dict) -> dict:
-    """Pass through all headers to Anthropic, stripping only hop-by-hop headers."""
-    skip = {"host", "content-length", "transfer-encoding", "connection"}
-    return {k: v for k, v in original_headers.items() if k.lower() not in skip}
+_HOP_BY_HOP_HEADERS = frozenset({"host", "content-length", "transfer-encoding", "connection"})
+
+
+def _build_anthropic_headers(original_headers: Mapping[str, str]) -> dict:
+    """Pass through all headers to Anthropic, stripping only hop-by-hop headers.
+
+    Accepts the request's Starlette ``Headers`` directly; no intermediate dict copy.
+    """
+    return {k: v for k, v in original_headers.items() if k.lower() not in _HOP_BY_HOP_HEADERS}
 
 
 @app.post("/v1/messages")
 async def proxy_messages(request: Request):
     rid = short_id()
-    data = await request.json()
+    raw = await request.body()
+    data = orjson.loads(raw)
     original_model = data.get("model", "")
     # Defense-in-depth: Claude Code strips [1m] before sending, but if any
     # client leaks it through, normalize before tier detection / forwarding.
@@ -1037,80 +1247,53 @@ async def proxy_messages(request: Request):
         original_model = original_model[:-4]
         data["model"] = original_model
     is_streaming = data.get("stream", False)
-    original_headers = dict(request.headers)
     stream_tag = "⇄" if is_streaming else "→"
-    original_data = None  # Lazy: only copied when needed for Z.AI fallback
 
-    provider_config = get_provider_config(original_model)
-    is_zai_route = provider_config is not None
-    bypass_reason = None
-
-    # ── Anthropic fallback for incompatible features ──
-    if provider_config:
-        bypass_reason = None
-        web_reason = _has_server_web_tools(data)
-        if web_reason:
-            bypass_reason = web_reason
-        elif _has_image_content(data):
-            bypass_reason = "vision/image"
-        elif _has_document_content(data):
-            bypass_reason = "document/pdf"
-        elif not ALLOW_FORCED_TOOL_CHOICE and _has_forced_tool_choice(data):
-            bypass_reason = "forced_tool_choice"
-
-        if bypass_reason:
-            provider_config = None  # → Anthropic OAuth
-            is_zai_route = False
-            log_route(rid, f"{original_model} {stream_tag} Anthropic ({bypass_reason} bypass)")
-
-    # ── Circuit breaker: bypass Z.AI if too many recent failures ──
-    tier = _detect_tier(original_model)
-    circuit_breaker_open = provider_config and tier and circuit_breaker.is_open(tier)
-    if circuit_breaker_open:
-        provider_config = None
-        is_zai_route = False
-        log_warn(rid, f"{original_model} {stream_tag} Anthropic (circuit breaker open for {tier})")
+    route = decide_route(original_model, data, raw, is_streaming)
+    tier = route.tier
+    is_zai_route = route.is_provider
+    provider_semaphore = route.semaphore
+    target_url = route.target_url
 
     # ── Route to Z.AI ──
-    if provider_config:
-        api_key, base_url, provider_label, provider_semaphore = provider_config
-        target_url = f"{base_url}/v1/messages"
-        target_headers = {"Content-Type": "application/json"}
-
-        if api_key:
-            target_headers["Authorization"] = f"Bearer {api_key}"
-            target_headers["x-api-key"] = api_key
+    if is_zai_route:
+        target_headers = PROVIDER_HEADERS[tier].copy()
+        anthropic_version = request.headers.get("anthropic-version")
+        if anthropic_version is not None:
+            target_headers["anthropic-version"] = anthropic_version
 
-        if "anthropic-version" in original_headers:
-            target_headers["anthropic-version"] = original_headers["anthropic-version"]
-
-        # Keep clean copy for Anthropic fallback before mutating
-        original_data = json.loads(json.dumps(data, default=str))
         # Rewrite model name to the tier-specific Z.AI model
         zai_model = _zai_model_for_tier(tier)
         data["model"] = zai_model
         # Sanitize Anthropic-specific parameters
-        data = sanitize_for_zai(data, rid)
+        data = sanitize_for_zai(data, rid, raw)
+        request_body = orjson.dumps(data)
 
-        log_route(rid, f"{original_model} {stream_tag} {provider_label}")
+        log_route(rid, "%s %s %s", original_model, stream_tag, route.provider_label)
 
     # ── Route to Anthropic (OAuth passthrough) ──
     else:
-        provider_semaphore = None
-        target_url = f"{ANTHROPIC_BASE_URL}/v1/messages"
-        target_headers = _build_anthropic_headers(original_headers)
+        target_headers = _build_anthropic_headers(request.headers)
 
-        # Strip foreign thinking blocks + extended_thinking before forwarding to Anthropic
-        _sanitize_for_anthropic(data, rid)
+        # Strip foreign thinking blocks + extended_thinking before forwarding to Anthropic.
+        # Nothing to strip → forward the client's original bytes untouched.
+        if _contains_any(raw, _ANTHROPIC_SANITIZE_MARKERS):
+            request_body = orjson.dumps(_sanitize_for_anthropic(data, rid))
+        else:
+            request_body = raw
 
-        # Only log if not already logged by bypass/circuit-breaker above
-        if not bypass_reason and not circuit_breaker_open:
-            auth_method = "OAuth" if "authorization" in original_headers else "API-Key"
-            log_route(rid, f"{original_model} {stream_tag} Anthropic ({auth_method})")
+        if route.bypass_reason:
+            log_route(rid, "%s %s Anthropic (%s bypass)", original_model, stream_tag, route.bypass_reason)
+        elif route.breaker_open:
+            log_warn(rid, f"{original_model} {stream_tag} Anthropic (circuit breaker open for {tier})")
+        else:
+            auth_method = "OAuth" if "authorization" in request.headers else "API-Key"
+            log_route(rid, "%s %s Anthropic (%s)", original_model, stream_tag, auth_method)
 
     # ── Execute request ──
-    client = request.app.state.http_client
-    sem = provider_semaphore if provider_semaphore else asyncio.Semaphore(9999)
+    anthropic_client = request.app.state.anthropic_client
+    client = request.app.state.provider_client if is_zai_route else anthropic_client
+    sem = provider_semaphore if provider_semaphore else _NO_LIMIT
     stats_tier = tier if is_zai_route and tier else "anthropic"
     price_tier = tier if is_zai_route and tier else None  # Scale pricing only for Z.AI routes
     max_attempts = MAX_RETRIES if is_zai_route else ANTHROPIC_MAX_RETRIES
@@ -1121,7 +1304,7 @@ async def proxy_messages(request: Request):
             try:
                 if is_streaming:
                     target_headers["Accept"] = "text/event-stream"
-                    req = client.build_request("POST", target_url, json=data, headers=target_headers)
+                    req = client.build_request("POST", target_url, content=request_body, headers=target_headers)
 
                     try:
                         response = await client.send(req, stream=True)
@@ -1136,17 +1319,18 @@ async def proxy_messages(request: Request):
                     if response.status_code >= 400:
                         body = await response.aread()
                         await response.aclose()
-                        body_str = body.decode(errors='replace')
-                        log_err(rid, f"Stream error {response.status_code}: {body_str[:500]}")
+                        log_err(rid, f"Stream error {response.status_code}: {body[:500].decode(errors='replace')}")
 
                         # Provider server error — retry on provider first, fallback last
                         # Exception: overload (529) → fallback immediately (retry worsens load)
                         # Exception: circuit breaker opened mid-flight → abort retries
-                        is_overload = _is_overloaded(response.status_code, body_str)
-                        breaker_now_open = bool(tier and circuit_breaker.is_open(tier))
-                        if is_zai_route and (_is_zai_server_error_status(response.status_code, body_str) or is_overload):
+                        # Plain client errors skip this entirely and are returned as-is
+                        # below: never retried, never counted against the breaker.
+                        is_overload = is_zai_route and _is_overloaded(response.status_code, body)
+                        if is_overload or (is_zai_route and _is_zai_server_error_status(response.status_code, body)):
+                            breaker_now_open = bool(tier and circuit_breaker.is_tripped(tier))
                             if tier:
-                                circuit_breaker.record_failure(tier)
+                                circuit_breaker.record_failure(tier, route.is_probe)
                             if not is_overload and not breaker_now_open and attempt < max_attempts - 1:
                                 log_warn(rid, f"Provider error ({response.status_code}), retrying provider ({attempt+2}/{max_attempts})")
                                 await asyncio.sleep(calculate_retry_delay(attempt))
@@ -1155,11 +1339,11 @@ async def proxy_messages(request: Request):
                             await stats.record(stats_tier, time.time() - request_start, is_error=True, is_fallback=True)
                             reason = "overloaded (529)" if is_overload else "retries exhausted"
                             log_warn(rid, f"Provider {reason}, falling back to Anthropic")
-                            fallback_headers = _build_anthropic_headers(original_headers)
+                            fallback_headers = _build_anthropic_headers(request.headers)
                             fallback_headers["Accept"] = "text/event-stream"
-                            _sanitize_for_anthropic(original_data, rid)
-                            fb_req = client.build_request("POST", f"{ANTHROPIC_BASE_URL}/v1/messages", json=original_data, headers=fallback_headers)
-                            fb_response = await client.send(fb_req, stream=True)
+                            fallback_body = _anthropic_fallback_body(raw, rid)
+                            fb_req = anthropic_client.build_request("POST", ANTHROPIC_MESSAGES_URL, content=fallback_body, headers=fallback_headers)
+                            fb_response = await anthropic_client.send(fb_req, stream=True)
                             if fb_response.status_code < 400:
                                 log_ok(rid, f"Anthropic fallback OK ({fb_response.status_code})")
                                 return StreamingResponse(
@@ -1171,7 +1355,7 @@ async def proxy_messages(request: Request):
                                 fb_body = await fb_response.aread()
                                 await fb_response.aclose()
                                 log_err(rid, f"Anthropic fallback also failed: {fb_response.status_code}: {fb_body.decode(errors='replace')[:500]}")
-                                return JSONResponse(status_code=fb_response.status_code, content=json.loads(fb_body) if fb_body else {"error": "Fallback failed"})
+                                return JSONResponse(status_code=fb_response.status_code, content=orjson.loads(fb_body) if fb_body else {"error": "Fallback failed"})
 
                         # Direct Anthropic route with error — retry with backoff before returning error
                         if not is_zai_route and response.status_code >= 500 and attempt < ANTHROPIC_MAX_RETRIES - 1:
@@ -1181,26 +1365,26 @@ async def proxy_messages(request: Request):
 
                         # For streaming errors, return JSON error (client expected SSE but got error)
                         try:
-                            error_data = json.loads(body_str) if body_str.strip() else {"error": {"type": "api_error", "message": f"HTTP {response.status_code}"}}
-                        except json.JSONDecodeError:
-                            error_data = {"error": {"type": "api_error", "message": body_str[:500] if body_str else f"HTTP {response.status_code}"}}
+                            error_data = orjson.loads(body) if body.strip() else {"error": {"type": "api_error", "message": f"HTTP {response.status_code}"}}
+                        except orjson.JSONDecodeError:
+                            error_data = {"error": {"type": "api_error", "message": body[:500].decode(errors='replace') if body else f"HTTP {response.status_code}"}}
                         await stats.record(stats_tier, time.time() - request_start, is_error=True)
                         return JSONResponse(status_code=response.status_code, content=error_data)
 
                     if is_zai_route and tier:
-                        circuit_breaker.record_success(tier)
+                        circuit_breaker.record_success(tier, route.is_probe)
                     await stats.record(stats_tier, time.time() - request_start)
                     retry_info = f" retry {attempt+1}/{max_attempts}" if attempt > 0 else ""
-                    log_ok(rid, f"Stream started ({response.status_code}){retry_info}")
+                    log_ok(rid, "Stream started (%d)%s", response.status_code, retry_info)
                     # Estimate input tokens for providers that don't return them (Z.AI)
-                    est_input = _estimate_input_tokens(data) if is_zai_route else 0
+                    est_input = _estimate_input_tokens(request_body) if is_zai_route else 0
                     return StreamingResponse(
                         safe_stream_wrapper(response.aiter_bytes(), rid, original_model, stats_tier=stats_tier, price_tier=price_tier, start_time=request_start, fallback_input_tokens=est_input),
                         media_type="text/event-stream",
                         background=BackgroundTask(response.aclose),
                     )
                 else:
-                    response = await client.post(target_url, json=data, headers=target_headers)
+                    response = await client.post(target_url, content=request_body, headers=target_headers)
 
                     if response.status_code == 429 and attempt < MAX_RETRIES - 1:
                         retry_after = response.headers.get("retry-after")
@@ -1210,17 +1394,21 @@ async def proxy_messages(request: Request):
                         continue
 
                     if response.status_code >= 400:
-                        log_err(rid, f"HTTP {response.status_code}: {response.text[:500]}")
+                        # Decode only the logged prefix, never the whole (possibly multi-KB) body
+                        resp_body = response.content
+                        log_err(rid, f"HTTP {response.status_code}: {resp_body[:500].decode(errors='replace')}")
 
                         # Provider server error — retry on provider first, fallback last
                         # Exception: overload (529) → fallback immediately (retry worsens load)
                         # Exception: circuit breaker opened mid-flight → abort retries
-                        body_text = response.text[:1000]
-                        is_overload = _is_overloaded(response.status_code, body_text)
-                        breaker_now_open = bool(tier and circuit_breaker.is_open(tier))
-                        if is_zai_route and (_is_zai_server_error_status(response.status_code, body_text) or is_overload):
+                        # Plain client errors skip this entirely and are returned as-is
+                        # below: never retried, never counted against the breaker.
+                        body_head = resp_body[:1000]
+                        is_overload = is_zai_route and _is_overloaded(response.status_code, body_head)
+                        if is_overload or (is_zai_route and _is_zai_server_error_status(response.status_code, body_head)):
+                            breaker_now_open = bool(tier and circuit_breaker.is_tripped(tier))
                             if tier:
-                                circuit_breaker.record_failure(tier)
+                                circuit_breaker.record_failure(tier, route.is_probe)
                             if not is_overload and not breaker_now_open and attempt < max_attempts - 1:
                                 log_warn(rid, f"Provider error ({response.status_code}), retrying provider ({attempt+2}/{max_attempts})")
                                 await asyncio.sleep(calculate_retry_delay(attempt))
@@ -1229,16 +1417,16 @@ async def proxy_messages(request: Request):
                             await stats.record(stats_tier, time.time() - request_start, is_error=True, is_fallback=True)
                             reason = "overloaded (529)" if is_overload else "retries exhausted"
                             log_warn(rid, f"Provider {reason}, falling back to Anthropic")
-                            fallback_headers = _build_anthropic_headers(original_headers)
-                            _sanitize_for_anthropic(original_data, rid)
-                            fb_response = await client.post(f"{ANTHROPIC_BASE_URL}/v1/messages", json=original_data, headers=fallback_headers)
+                            fallback_headers = _build_anthropic_headers(request.headers)
+                            fallback_body = _anthropic_fallback_body(raw, rid)
+                            fb_response = await anthropic_client.post(ANTHROPIC_MESSAGES_URL, content=fallback_body, headers=fallback_headers)
                             if fb_response.status_code < 400:
                                 log_ok(rid, f"Anthropic fallback OK ({fb_response.status_code})")
                                 inp, out = _extract_tokens_from_response(fb_response.content)
                                 if inp or out:
                                     await stats.record_tokens("anthropic", inp, out)
                             else:
-                                log_err(rid, f"Anthropic fallback also failed: {fb_response.status_code}: {fb_response.text[:500]}")
+                                log_err(rid, f"Anthropic fallback also failed: {fb_response.status_code}: {fb_response.content[:500].decode(errors='replace')}")
                             return Response(
                                 content=fb_response.content,
                                 status_code=fb_response.status_code,
@@ -1253,23 +1441,25 @@ async def proxy_messages(request: Request):
 
                     if response.status_code < 400:
                         if is_zai_route and tier:
-                            circuit_breaker.record_success(tier)
+                            circuit_breaker.record_success(tier, route.is_probe)
                         elapsed = time.time() - request_start
                         await stats.record(stats_tier, elapsed)
                         inp, out = _extract_tokens_from_response(response.content)
                         # Fallback: estimate input tokens when provider doesn't return them
                         in_prefix = ""
                         if inp == 0 and out > 0 and is_zai_route:
-                            inp = _estimate_input_tokens(data)
+                            inp = _estimate_input_tokens(request_body)
                             in_prefix = "~"
                         retry_info = f" retry {attempt+1}/{max_attempts}" if attempt > 0 else ""
                         if inp or out:
                             await stats.record_tokens(stats_tier, inp, out)
-                            fmt = stats._fmt_tokens
-                            cost_str = _fmt_cost(inp, out, stats_tier)
-                            log_ok(rid, f"OK {in_prefix}{fmt(inp)} in / {fmt(out)} out ({elapsed:.1f}s){cost_str}{retry_info}")
-                        else:
-                            log_ok(rid, f"OK ({elapsed:.1f}s){retry_info}")
+                        if logger.isEnabledFor(logging.INFO):
+                            if inp or out:
+                                fmt = stats._fmt_tokens
+                                cost_str = _fmt_cost(inp, out, stats_tier)
+                                log_ok(rid, f"OK {in_prefix}{fmt(inp)} in / {fmt(out)} out ({elapsed:.1f}s){cost_str}{retry_info}")
+                            else:
+                                log_ok(rid, "OK (%.1fs)%s", elapsed, retry_info)
                     else:
                         await stats.record(stats_tier, time.time() - request_start, is_error=True)
                     # Scale tokens in non-streaming response for correct cost display
@@ -1285,7 +1475,7 @@ async def proxy_messages(request: Request):
             except httpx.ReadTimeout:
                 log_err(rid, f"Read timeout (attempt {attempt+1}/{MAX_RETRIES})")
                 if is_zai_route and tier:
-                    circuit_breaker.record_failure(tier)
+                    circuit_breaker.record_failure(tier, route.is_probe)
                 if attempt < MAX_RETRIES - 1:
                     await asyncio.sleep(calculate_retry_delay(attempt))
                     continue
@@ -1294,9 +1484,9 @@ async def proxy_messages(request: Request):
                     await stats.record(stats_tier, time.time() - request_start, is_error=True, is_fallback=True)
                     log_warn(rid, "Provider timeout, falling back to Anthropic")
                     try:
-                        fallback_headers = _build_anthropic_headers(original_headers)
-                        _sanitize_for_anthropic(original_data, rid)
-                        fb_response = await client.post(f"{ANTHROPIC_BASE_URL}/v1/messages", json=original_data, headers=fallback_headers)
+                        fallback_headers = _build_anthropic_headers(request.headers)
+                        fallback_body = _anthropic_fallback_body(raw, rid)
+                        fb_response = await anthropic_client.post(ANTHROPIC_MESSAGES_URL, content=fallback_body, headers=fallback_headers)
                         elapsed = time.time() - request_start
                         if fb_response.status_code < 400:
                             inp, out = _extract_tokens_from_response(fb_response.content)
@@ -1307,7 +1497,7 @@ async def proxy_messages(request: Request):
                             else:
                                 log_ok(rid, f"Anthropic fallback OK ({elapsed:.1f}s)")
                         else:
-                            log_err(rid, f"Anthropic fallback also failed: {fb_response.status_code}: {fb_response.text[:500]}")
+                            log_err(rid, f"Anthropic fallback also failed: {fb_response.status_code}: {fb_response.content[:500].decode(errors='replace')}")
                         return Response(content=fb_response.content, status_code=fb_response.status_code, headers=strip_encoding_headers(fb_response.headers))
                     except Exception as fb_err:
                         log_err(rid, f"Anthropic fallback also failed: {fb_err}")
@@ -1319,17 +1509,17 @@ async def proxy_messages(request: Request):
                     await asyncio.sleep(calculate_retry_delay(attempt))
                     continue
                 # All retries exhausted — fallback to Anthropic
-                if is_zai_route and original_data:
+                if is_zai_route:
                     await stats.record(stats_tier, time.time() - request_start, is_error=True, is_fallback=True)
                     log_warn(rid, "Provider unreachable, falling back to Anthropic")
                     try:
-                        fallback_headers = _build_anthropic_headers(original_headers)
-                        _sanitize_for_anthropic(original_data, rid)
-                        fb_response = await client.post(f"{ANTHROPIC_BASE_URL}/v1/messages", json=original_data, headers=fallback_headers)
+                        fallback_headers = _build_anthropic_headers(request.headers)
+                        fallback_body = _anthropic_fallback_body(raw, rid)
+                        fb_response = await anthropic_client.post(ANTHROPIC_MESSAGES_URL, content=fallback_body, headers=fallback_headers)
                         if fb_response.status_code < 400:
                             log_ok(rid, f"Anthropic fallback OK ({fb_response.status_code})")
                         else:
-                            log_err(rid, f"Anthropic fallback also failed: {fb_response.status_code}: {fb_response.text[:500]}")
+                            log_err(rid, f"Anthropic fallback also failed: {fb_response.status_code}: {fb_response.content[:500].decode(errors='replace')}")
                         return Response(content=fb_response.content, status_code=fb_response.status_code, headers=strip_encoding_headers(fb_response.headers))
                     except Exception as fb_err:
                         log_err(rid, f"Anthropic fallback also failed: {fb_err}")
@@ -1345,17 +1535,17 @@ async def proxy_messages(request: Request):
                     await asyncio.sleep(calculate_retry_delay(attempt))
                     continue
                 # All retries exhausted — fallback to Anthropic
-                if is_zai_route and original_data:
+                if is_zai_route:
                     await stats.record(stats_tier, time.time() - request_start, is_error=True, is_fallback=True)
                     log_warn(rid, "Provider error, falling back to Anthropic")
                     try:
-                        fallback_headers = _build_anthropic_headers(original_headers)
-                        _sanitize_for_anthropic(original_data, rid)
-                        fb_response = await client.post(f"{ANTHROPIC_BASE_URL}/v1/messages", json=original_data, headers=fallback_headers)
+                        fallback_headers = _build_anthropic_headers(request.headers)
+                        fallback_body = _anthropic_fallback_body(raw, rid)
+                        fb_response = await anthropic_client.post(ANTHROPIC_MESSAGES_URL, content=fallback_body, headers=fallback_headers)
                         if fb_response.status_code < 400:
                             log_ok(rid, f"Anthropic fallback OK ({fb_response.status_code})")
                         else:
-                            log_err(rid, f"Anthropic fallback also failed: {fb_response.status_code}: {fb_response.text[:500]}")
+                            log_err(rid, f"Anthropic fallback also failed: {fb_response.status_code}: {fb_response.content[:500].decode(errors='replace')}")
                         return Response(content=fb_response.content, status_code=fb_response.status_code, headers=strip_encoding_headers(fb_response.headers))
                     except Exception as fb_err:
                         log_err(rid, f"Anthropic fallback also failed: {fb_err}")
@@ -1372,34 +1562,33 @@ async def proxy_messages(request: Request):
 @app.post("/v1/messages/count_tokens")
 async def proxy_count_tokens(request: Request):
     rid = short_id()
-    data = await request.json()
+    data = orjson.loads(await request.body())
     original_model = data.get("model", "")
     if original_model.endswith("[1m]"):
         original_model = original_model[:-4]
         data["model"] = original_model
-    original_headers = dict(request.headers)
 
     # Always forward to Anthropic for token counting
     target_url = f"{ANTHROPIC_BASE_URL}/v1/messages/count_tokens"
-    target_headers = _build_anthropic_headers(original_headers)
+    target_headers = _build_anthropic_headers(request.headers)
 
     # Strip thinking blocks from history — foreign provider signatures cause 400 errors
     if _has_mixed_providers():
         stripped = _strip_thinking_from_history(data)
         if stripped:
-            logger.debug(f"[{rid}] count_tokens: stripped {stripped} thinking blocks")
+            logger.debug("[%s] count_tokens: stripped %d thinking blocks", rid, stripped)
 
-    logger.debug(f"[{rid}] count_tokens {original_model} → Anthropic")
+    logger.debug("[%s] count_tokens %s → Anthropic", rid, original_model)
 
-    client = request.app.state.http_client
+    client = request.app.state.anthropic_client
     count_start = time.time()
     try:
-        response = await client.post(target_url, json=data, headers=target_headers)
+        response = await client.post(target_url, content=orjson.dumps(data), headers=target_headers)
         elapsed = time.time() - count_start
         if response.status_code >= 400:
-            log_err(rid, f"count_tokens HTTP {response.status_code}: {response.text[:300]}")
+            log_err(rid, f"count_tokens HTTP {response.status_code}: {response.content[:300].decode(errors='replace')}")
         else:
-            logger.debug(f"[{rid}] count_tokens OK ({elapsed:.1f}s)")
+            logger.debug("[%s] count_tokens OK (%.1fs)", rid, elapsed)
         return Response(
             content=response.content,
             status_code=response.status_code,
@@ -1502,13 +1691,12 @@ async def catch_all(request: Request, path: str):
     rid = short_id()
     method = request.method
     target_url = f"{ANTHROPIC_BASE_URL}/{path}"
-    original_headers = dict(request.headers)
-    target_headers = _build_anthropic_headers(original_headers)
-    wants_stream = original_headers.get("accept", "") == "text/event-stream"
+    target_headers = _build_anthropic_headers(request.headers)
+    wants_stream = request.headers.get("accept", "") == "text/event-stream"
 
-    log_route(rid, f"catch-all {method} /{path} → Anthropic{' (stream)' if wants_stream else ''}")
+    log_route(rid, "catch-all %s /%s → Anthropic%s", method, path, " (stream)" if wants_stream else "")
 
-    client = request.app.state.http_client
+    client = request.app.state.anthropic_client
     catch_start = time.time()
     try:
         body = await request.body()
@@ -1529,9 +1717,9 @@ async def catch_all(request: Request, path: str):
             response = await client.request(method, target_url, content=body, headers=target_headers)
             elapsed = time.time() - catch_start
             if response.status_code < 400:
-                log_ok(rid, f"catch-all OK ({response.status_code}, {elapsed:.1f}s)")
+                log_ok(rid, "catch-all OK (%d, %.1fs)", response.status_code, elapsed)
             else:
-                log_err(rid, f"catch-all HTTP {response.status_code}: {response.text[:300]}")
+                log_err(rid, f"catch-all HTTP {response.status_code}: {response.content[:300].decode(errors='replace')}")
             return Response(
                 content=response.content,
                 status_code=response.status_code,